@@ -0,0 +1,8 @@
+# Gunicorn settings, picked up automatically by `gunicorn main:app`
+import os
+
+bind = "0.0.0.0:7999"
+worker_class = "uvicorn_worker.UvicornWorker"
+# cpu_count() reports the host's cores, not the container's CPU quota, so the
+# worker count is set explicitly (the Dockerfile sets WEB_CONCURRENCY)
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
@@ -1,22 +1,89 @@
-from fastapi import FastAPI, Request, HTTPException, Depends, status
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, Request, Response, HTTPException, Depends, status
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from contextlib import asynccontextmanager
 import asyncio
-import httpx
+import logging
+import aiohttp
+import orjson
+from yarl import URL
 import uvicorn
 import os
+import time
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from typing import Optional
 
-app = FastAPI()
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+async def _log_connection_created(session, context, params):
+    logger.debug("Opened new upstream connection")
+
+async def _log_connection_reused(session, context, params):
+    logger.debug("Reused pooled upstream connection")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Tracing costs a few callbacks per request, so only attach it when
+    # debug logging is on to check connections are being kept alive
+    trace_configs = []
+    if logger.isEnabledFor(logging.DEBUG):
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(_log_connection_created)
+        trace_config.on_connection_reuseconn.append(_log_connection_reused)
+        trace_configs.append(trace_config)
+
+    # One long-lived client for all upstream calls so connections to the
+    # DB and filter services are kept alive and reused across requests
+    app.state.http = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=UPSTREAM_CONNECTION_LIMIT,
+            limit_per_host=UPSTREAM_CONNECTION_LIMIT_PER_HOST,
+            keepalive_timeout=75,
+            ttl_dns_cache=300,
+        ),
+        timeout=aiohttp.ClientTimeout(total=10, connect=5),
+        trace_configs=trace_configs,
+    )
+    # SSE streams hold their upstream connection for as long as the browser
+    # stays connected, so they get their own uncapped pool and can't starve
+    # the request/response calls above
+    app.state.stream_http = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=0, ttl_dns_cache=300),
+        timeout=aiohttp.ClientTimeout(total=None, connect=5),
+    )
+    app.state.cache = ResponseCache()
+    yield
+    await app.state.cache.aclose()
+    await app.state.http.close()
+    await app.state.stream_http.close()
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+
+class OriginCORSMiddleware(CORSMiddleware):
+    """
+    CORSMiddleware that hands requests without an Origin header (SSE
+    consumers, server-to-server calls, health checks) straight to the app
+    without parsing their headers.
+    """
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            for name, _ in scope["headers"]:
+                if name == b"origin":
+                    break
+            else:
+                await self.app(scope, receive, send)
+                return
+        await super().__call__(scope, receive, send)
 
 # Adjust these if frontend is served from somewhere else
 # origins = ["http://localhost:3000", "http://127.0.0.1:3000"]
 # origins = ["https://frontend.delightfulwater-b24a63e0.uksouth.azurecontainerapps.io"]
 origins = ["*"]
 app.add_middleware(
-    CORSMiddleware,
+    OriginCORSMiddleware,
     allow_origins=origins,
     allow_credentials=True,
     allow_methods=["*"],
@@ -28,13 +95,45 @@ DATABASE_SERVICE_URL = "https://starmap-service.delightfulwater-b24a63e0.uksouth
 # FILTER_SERVICE_URL = "http://127.0.0.1:7000"
 FILTER_SERVICE_URL = "https://comment-filter.delightfulwater-b24a63e0.uksouth.azurecontainerapps.io"
 
+# Upstream URLs parsed once at startup; per-star URLs are joined onto these
+STARS_URL = URL(f"{DATABASE_SERVICE_URL}/stars/")
+STAR_EVENTS_URL = URL(f"{DATABASE_SERVICE_URL}/events/stars/stream")
+FILTER_URL = URL(f"{FILTER_SERVICE_URL}/filter")
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Upstream connection limits for each worker process
+UPSTREAM_CONNECTION_LIMIT = 200
+UPSTREAM_CONNECTION_LIMIT_PER_HOST = 50
+
+# How many SSE chunks to forward between client disconnect checks
+SSE_DISCONNECT_CHECK_INTERVAL = 16
+
+# How long (seconds) upstream read responses are served from the cache.
+# Each worker has its own cache and writes only invalidate the worker that
+# handled them, so other workers can serve data this stale after a write.
+STARS_CACHE_TTL = 2
+STAR_CACHE_TTL = 2
+RESPONSE_CACHE_MAX_ENTRIES = 10000
+
 # JWT Authentication Configuration
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key") # TODO configure to real secret key
 ALGORITHM = "HS256"
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login")
 
+# Decoded tokens: raw token -> (expiry timestamp, email), oldest first
+JWT_CACHE_MAX_ENTRIES = 10000
+_jwt_cache: dict[str, tuple[float, str]] = {}
+
 # Function to extract and verify JWT token
 async def get_current_user(token: str = Depends(oauth2_scheme)):
+    # Skip re-verifying a token we've already decoded until it expires
+    cached = _jwt_cache.get(token)
+    if cached is not None:
+        if cached[0] > time.time():
+            return cached[1]
+        del _jwt_cache[token]
+
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -47,21 +146,125 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
             raise credentials_exception
     except JWTError:
         raise credentials_exception
+
+    # Only cache tokens that carry an expiry
+    exp = payload.get("exp")
+    if exp is not None:
+        if len(_jwt_cache) >= JWT_CACHE_MAX_ENTRIES:
+            del _jwt_cache[next(iter(_jwt_cache))]
+        _jwt_cache[token] = (exp, email)
     
     # Verify user exists (consider querying auth service)
     return email  # You could fetch the user object if needed
 
+# -------------------------
+# Response Cache
+# -------------------------
+
+class ResponseCache:
+    """
+    In-memory TTL cache of upstream response bodies keyed on path.
+    Concurrent misses for the same key share a single upstream fetch,
+    including its error if it fails.
+    """
+
+    def __init__(self, max_entries=RESPONSE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = {}
+        self._in_flight = {}
+        # Every running fetch, including ones dropped by invalidate()
+        self._tasks = set()
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        return None
+
+    async def get_or_fetch(self, key, ttl, fetch):
+        content = self._lookup(key)
+        if content is not None:
+            return content
+
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(key, ttl, fetch))
+            self._in_flight[key] = task
+            self._tasks.add(task)
+            task.add_done_callback(lambda done: self._fetch_done(key, done))
+        # Shielded so one caller disconnecting doesn't cancel the fetch
+        # for everyone else waiting on it
+        return await asyncio.shield(task)
+
+    async def _fetch(self, key, ttl, fetch):
+        content = await fetch()
+        # Don't store a result that was invalidated while in flight
+        if self._in_flight.get(key) is asyncio.current_task():
+            self._store(key, ttl, content)
+        return content
+
+    def _fetch_done(self, key, task):
+        self._tasks.discard(task)
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        # Mark the error as retrieved in case every waiter went away
+        if not task.cancelled():
+            task.exception()
+
+    def _store(self, key, ttl, content):
+        if len(self._entries) >= self.max_entries:
+            now = time.monotonic()
+            for stale in [k for k, (expiry, _) in self._entries.items() if expiry <= now]:
+                del self._entries[stale]
+            while len(self._entries) >= self.max_entries:
+                del self._entries[next(iter(self._entries))]
+        self._entries[key] = (time.monotonic() + ttl, content)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+        # Later callers start a fresh fetch rather than joining a stale one
+        self._in_flight.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+        self._in_flight.clear()
+
+    async def aclose(self):
+        """
+        Cancel upstream fetches still in flight and wait for them to
+        finish, so none outlive the HTTP session on shutdown.
+        """
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+# -------------------------
+# Star Lookups
+# -------------------------
+
+async def fetch_stars(client):
+    async with client.get(STARS_URL) as resp:
+        if resp.status != 200:
+            raise HTTPException(status_code=resp.status, detail=await resp.text())
+        return await resp.read()
+
+async def fetch_star(client, star_id):
+    async with client.get(STARS_URL / star_id) as resp:
+        if resp.status != 200:
+            raise HTTPException(status_code=resp.status, detail=await resp.text())
+        return await resp.read()
+
 # -------------------------
 # Public Routes
 # -------------------------
 
 @app.get("/stars")
-async def get_stars():
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(f"{DATABASE_SERVICE_URL}/stars/")
-    if resp.status_code != 200:
-        raise HTTPException(status_code=resp.status_code, detail=resp.text)
-    return resp.json()
+async def get_stars(request: Request):
+    content = await request.app.state.cache.get_or_fetch(
+        "/stars", STARS_CACHE_TTL, lambda: fetch_stars(request.app.state.http)
+    )
+    return Response(content=content, media_type="application/json")
 
 @app.get("/stars/stream")
 async def stream_stars(request: Request):
@@ -70,133 +273,208 @@ async def stream_stars(request: Request):
     can connect to us instead of calling the DB directly.
     """
     async def event_generator():
-        async with httpx.AsyncClient(timeout=None) as client:
-            async with client.stream("GET", f"{DATABASE_SERVICE_URL}/events/stars/stream") as r:
-                async for line in r.aiter_lines():
-                    if await request.is_disconnected():
-                        break
-                    yield f"{line}\n"
+        client = request.app.state.stream_http
+        # Ask for an uncompressed stream so chunks can be forwarded as-is,
+        # without running them through aiohttp's decompressor
+        async with client.get(
+            STAR_EVENTS_URL,
+            headers={"Accept-Encoding": "identity"},
+            allow_redirects=False,
+            auto_decompress=False,
+        ) as r:
+            chunks = 0
+            async for chunk in r.content.iter_any():
+                # Checking for disconnects awaits the ASGI receive channel,
+                # so only do it every few chunks
+                if chunks % SSE_DISCONNECT_CHECK_INTERVAL == 0 and await request.is_disconnected():
+                    break
+                chunks += 1
+                yield chunk
 
     return StreamingResponse(event_generator(), media_type="text/event-stream")
 
 @app.get("/stars/{star_id}")
-async def get_star(star_id):
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(f"{DATABASE_SERVICE_URL}/stars/{star_id}")
-    if resp.status_code != 200:
-        raise HTTPException(status_code=resp.status_code, detail=resp.text)
-    return resp.json()
+async def get_star(request: Request, star_id):
+    content = await request.app.state.cache.get_or_fetch(
+        f"/stars/{star_id}",
+        STAR_CACHE_TTL,
+        lambda: fetch_star(request.app.state.http, star_id),
+    )
+    return Response(content=content, media_type="application/json")
 
 # -------------------------
 # Protected Routes (Require Authentication)
 # -------------------------
 
-@app.post("/stars")
+# The body is checked and forwarded as raw bytes, so describe it for the
+# OpenAPI docs by hand instead of declaring a parsed parameter
+@app.post(
+    "/stars",
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {"application/json": {"schema": {"type": "object"}}},
+        }
+    },
+)
 async def create_star(
-    star_data: dict,
+    request: Request,
     current_user: str = Depends(get_current_user)
 ):
     """
     Protected: Only authenticated users can create stars.
     """
+    body = await request.body()
+
+    # Reject anything that isn't a JSON object before it reaches the
+    # filter or DB service; the original bytes are forwarded as-is
+    try:
+        star_data = orjson.loads(body)
+    except orjson.JSONDecodeError:
+        star_data = None
+    if not isinstance(star_data, dict):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Request body must be a JSON object",
+        )
+
     # Log the incoming star data for debugging
-    print("Incoming star data:", star_data)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Incoming star data: %s", star_data)
 
     # star_data["Username"] = current_user # TODO Arnie ????
 
-    # Send the full star data to the filter service
-    async with httpx.AsyncClient() as client:
-        # Forward the entire star_data to the filter service
-        resp = await client.post(f"{FILTER_SERVICE_URL}/filter", json=star_data)
+    client = request.app.state.http
 
+    # Forward the entire star data to the filter service
+    async with client.post(FILTER_URL, data=body, headers=JSON_HEADERS) as resp:
         # Log the response from the filter service for debugging
-        print("Response from filter service:", resp.json())
+        logger.debug("Response from filter service: %s", resp.status)
 
         # Check if the response status code is 200 (OK)
-        if resp.status_code == 200:
-            # Parse the JSON response to get the status and message
-            filter_response = resp.json()
-            is_acceptable = filter_response.get("status")
-
-            # If message is acceptable
-            if is_acceptable:
-                # Forward to database
-                async with httpx.AsyncClient() as client:
-                    db_resp = await client.post(
-                        f"{DATABASE_SERVICE_URL}/stars/", json=star_data
-                    )
-                if db_resp.status_code != 200:
-                    raise HTTPException(
-                        status_code=db_resp.status_code, detail=db_resp.text
-                    )
-                return db_resp.json()
-            else:
-                # Return the filter service's response message if message
-                # is inappropriate
-                return filter_response
-        else:
+        if resp.status != 200:
             # Raise an exception if the filter service returns an error
-            raise HTTPException(status_code=resp.status_code, detail=resp.text)
+            raise HTTPException(status_code=resp.status, detail=await resp.text())
+
+        # Parse the JSON response to get the status and message
+        filter_body = await resp.read()
+        filter_response = orjson.loads(filter_body)
+
+    is_acceptable = filter_response.get("status")
+
+    # If message is acceptable
+    if is_acceptable:
+        # Forward to database
+        async with client.post(STARS_URL, data=body, headers=JSON_HEADERS) as db_resp:
+            if db_resp.status != 200:
+                raise HTTPException(
+                    status_code=db_resp.status, detail=await db_resp.text()
+                )
+            request.app.state.cache.invalidate("/stars")
+            return Response(
+                content=await db_resp.read(),
+                media_type="application/json",
+                status_code=db_resp.status,
+            )
+    else:
+        # Return the filter service's response message if message
+        # is inappropriate
+        return Response(content=filter_body, media_type="application/json")
 
 # @app.delete("/stars/{star_id}")
 # async def delete_star(
+#     request: Request,
 #     star_id: int,
 #     current_user: str = Depends(get_current_user)
 # ):
 #     """
 #     Protected: Only authenticated users can delete stars.
 #     """
-#     async with httpx.AsyncClient() as client:
-#         resp = await client.delete(f"{DATABASE_SERVICE_URL}/stars/{star_id}")
-#     if resp.status_code != 200:
-#         raise HTTPException(status_code=resp.status_code, detail=resp.text)
-#     return resp.json()
+#     async with request.app.state.http.delete(STARS_URL / str(star_id)) as resp:
+#         if resp.status != 200:
+#             raise HTTPException(status_code=resp.status, detail=await resp.text())
+#         request.app.state.cache.invalidate("/stars")
+#         request.app.state.cache.invalidate(f"/stars/{star_id}")
+#         return Response(
+#             content=await resp.read(),
+#             media_type="application/json",
+#             status_code=resp.status,
+#         )
 
 # @app.delete("/stars")
 # async def delete_all_stars(
+#     request: Request,
 #     current_user: str = Depends(get_current_user)
 # ):
 #     """
 #     ⚠️ Dangerous: Only authenticated users can delete all stars.
 #     """
-#     async with httpx.AsyncClient() as client:
-#         resp = await client.delete(f"{DATABASE_SERVICE_URL}/stars")
-#     if resp.status_code != 200:
-#         raise HTTPException(status_code=resp.status_code, detail=resp.text)
-#     return resp.json()
+#     async with request.app.state.http.delete(f"{DATABASE_SERVICE_URL}/stars") as resp:
+#         if resp.status != 200:
+#             raise HTTPException(status_code=resp.status, detail=await resp.text())
+#         request.app.state.cache.clear()
+#         return Response(
+#             content=await resp.read(),
+#             media_type="application/json",
+#             status_code=resp.status,
+#         )
 
 @app.post("/stars/{star_id}/like")
 async def like_star(
+    request: Request,
     star_id: str,
     current_user: str = Depends(get_current_user)
 ):
     """
     Protected: Only authenticated users can like stars.
     """
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(f"{DATABASE_SERVICE_URL}/stars/{star_id}/like")
-    if resp.status_code != 200:
-        raise HTTPException(status_code=resp.status_code, detail=resp.text)
-    return resp.json()
+    async with request.app.state.http.post(STARS_URL / star_id / "like") as resp:
+        if resp.status != 200:
+            raise HTTPException(status_code=resp.status, detail=await resp.text())
+        request.app.state.cache.invalidate("/stars")
+        request.app.state.cache.invalidate(f"/stars/{star_id}")
+        return Response(
+            content=await resp.read(),
+            media_type="application/json",
+            status_code=resp.status,
+        )
 
 @app.post("/stars/{star_id}/dislike")
 async def dislike_star(
+    request: Request,
     star_id: str,
     current_user: str = Depends(get_current_user)
 ):
     """
     Protected: Only authenticated users can like stars.
     """
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(f"{DATABASE_SERVICE_URL}/stars/{star_id}/dislike")
-    if resp.status_code != 200:
-        raise HTTPException(status_code=resp.status_code, detail=resp.text)
-    return resp.json()
+    async with request.app.state.http.post(STARS_URL / star_id / "dislike") as resp:
+        if resp.status != 200:
+            raise HTTPException(status_code=resp.status, detail=await resp.text())
+        request.app.state.cache.invalidate("/stars")
+        request.app.state.cache.invalidate(f"/stars/{star_id}")
+        return Response(
+            content=await resp.read(),
+            media_type="application/json",
+            status_code=resp.status,
+        )
 
 
 # -------------------------
 # Run Server
 # -------------------------
 
+# In production this runs under gunicorn with one uvicorn worker process
+# per core (see gunicorn.conf.py):
+#   gunicorn main:app
+# Running this file directly starts a single process for local use.
+
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="127.0.0.1", port=7999, reload=True)
+    uvicorn.run(
+        "main:app",
+        host="127.0.0.1",
+        port=7999,
+        # "auto" picks uvloop where it's installed (not on Windows)
+        loop="auto",
+        http="httptools",
+    )